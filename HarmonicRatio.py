@@ -15,8 +15,7 @@
 # [14] Menz HB, Lord SR, Fitzpatrick RC: Acceleration patterns of the head and pelvis when walking are associated with risk of falling in community-dwelling older people. J Gerontol A Biol Sci Med Sci 2003.
 
 import numpy as np
-import plotly.express as px
-import pandas as pd
+import plotly.graph_objects as go
 from scipy import fft
 
 
@@ -38,6 +37,7 @@ class HarmonicRatio:
 
         #Other variable initializations
         self.current_period = [] #Constantly refreshed array for most immediate analysis
+        self.twiddle = None #DFT coefficients of the harmonics, cached for window sizes that are slow to fft
 
         self.hr = -1 #initialize return value as -1 so immediate red flag if code is not running.
         self.data_refresh_rate = freq #Hz
@@ -54,15 +54,24 @@ class HarmonicRatio:
         # window_delta -> increment of window after each analysis
         # filename -> .HTML file for charts to output after each run
 
-        hr_arr = []
-        # iterate over dataset, processing each window and saving the hr to an array to plot
-        for n in range(window_size, len(dataset), window_delta):
-            self.current_period = dataset[n - window_size:n]
-            hr_arr.append(self.process_event())
+        dataset = np.asarray(dataset, dtype=np.float64)
 
-        #create array of x values to plot the y values against
-        x_arr = np.multiply(list(range(window_size // window_delta, len(hr_arr) + window_size // window_delta)),
-                            window_delta)
+        # view of every window without copying, ending at window_size then every window_delta frames up to the last frame
+        if len(dataset) > window_size:
+            windows = np.lib.stride_tricks.sliding_window_view(dataset[:-1], window_size)[::window_delta]
+        else:
+            windows = np.empty((0, window_size))
+
+        # transform blocks of windows in one batched rfft each (spread over all cores) and save the hr of each window
+        # blocks keep the frequency output from growing with the length of the dataset
+        block_windows = 1024
+        hr_arr = np.empty(len(windows))
+        for start in range(0, len(windows), block_windows):
+            fft_output = self.transform(windows[start:start + block_windows])
+            hr_arr[start:start + block_windows] = self.harmonic_ratio(fft_output)
+
+        #create array of x values to plot the y values against (the frame each window ends at)
+        x_arr = np.arange(window_size, window_size + len(hr_arr) * window_delta, window_delta)
 
         #If filename is not filled in, skip file output and just return array of harmonic ratio values
         if filename != "":
@@ -72,68 +81,74 @@ class HarmonicRatio:
                 f.write(f"<h2>Window Delta:{window_delta}</h2>\n")
                 f.write("<hr>\n<hr>\n")
                 f.write(f"<h3>Signal Plot Over Time:</h3>\n")
-                self.plot_line(dataset, list(range(0, len(dataset))), f)
+                self.plot_line(dataset, np.arange(0, len(dataset)), f)
                 f.write(f"<h3>Harmonic Ratio over Time:</h3>\n")
-                self.plot_line(hr_arr, x_arr, f)
+                self.plot_line(hr_arr, x_arr, f, include_plotlyjs=False)
 
         return hr_arr
 
 
-    def process_event(self):
+    def process_event(self, fft_output=None):
         # Process current_period array to extract and return harmonic ratio
-
-        N = len(self.current_period) # number of sample points
-        T = 1 / self.data_refresh_rate # sample spacing (refresh rate)
+        # fft_output -> precomputed frequency bins of current_period (at least the first 20). Computed here if not given.
 
         #use fft on signal to obtain frequency domain representation
-        fft_output = fft.rfft(self.current_period)
-        fft_freqs = fft.rfftfreq(N, T)
-
-        #display functions for individual testing
-        #self.plot_line(self.current_period, list(range(0, N)))
-        #self.plot_line(np.abs(fft_output), fft_freqs)
-        #print(fft_freqs)
-
-        #sums first 10 even and odd harmonic amplitudes
-        even_harmonics = 0
-        odd_harmonics = 0
-        for x in range(0, 20):
-            if x % 2 == 0:
-                #odd
-                odd_harmonics += np.abs(fft_output[x])
-                #print(f"odd:{odd_harmonics}")
-            else:
-                #even
-                even_harmonics += np.abs(fft_output[x])
-                #print(f"even:{even_harmonics}")
-
-        # calculates appropriate ratio based on axis of computation
-        try:
-            if self.axis == "z":
-                hr = odd_harmonics / even_harmonics
-            else:
-                hr = even_harmonics / odd_harmonics
-        except:
-            hr = 0
-
-        #print(even_harmonics, odd_harmonics, hr, np.sum(self.current_period))
-        return np.real(hr)
-
-
-    def plot_line(self, y, x, f, title=''):
+        if fft_output is None:
+            fft_output = self.transform(self.current_period)
+
+        return float(self.harmonic_ratio(fft_output))
+
+
+    def transform(self, windows):
+        # Compute frequency bins (at least the first 20 harmonics) of each window along the last axis
+        # windows -> one window, or many windows stacked along the first axis
+
+        N = np.shape(windows)[-1]
+        if fft.next_fast_len(N, real=True) == N:
+            return fft.rfft(windows, axis=-1, workers=-1)
+
+        # window sizes with large prime factors are slow to fft, and zero-padding them would move the harmonics,
+        # so compute only the needed bins as a matrix multiply with coefficients cached for this window size.
+        # real and imaginary coefficients sit side by side so the strided windows are only read (and copied) once
+        if self.twiddle is None or len(self.twiddle) != N:
+            angles = 2 * np.pi * np.outer(np.arange(0, N), np.arange(0, min(20, N // 2 + 1))) / N
+            self.twiddle = np.hstack((np.cos(angles), -np.sin(angles)))
+        bins = np.dot(windows, self.twiddle)
+        harmonics = self.twiddle.shape[1] // 2
+        return bins[..., :harmonics] + 1j * bins[..., harmonics:]
+
+
+    def harmonic_ratio(self, fft_output):
+        # Compute harmonic ratio from frequency bins, one ratio per window along the last axis
+        # fft_output -> frequency bins of one window, or of many windows stacked along the first axis
+
+        #sums first 10 even and odd harmonic amplitudes (even indices are counted as odd harmonics)
+        magnitudes = np.abs(fft_output[..., :20])
+        odd_harmonics = magnitudes[..., 0::2].sum(-1)
+        even_harmonics = magnitudes[..., 1::2].sum(-1)
+
+        # calculates appropriate ratio based on axis of computation, 0 if there is nothing to divide by
+        if self.axis == "z":
+            numerator, denominator = odd_harmonics, even_harmonics
+        else:
+            numerator, denominator = even_harmonics, odd_harmonics
+        hr = np.divide(numerator, denominator, out=np.zeros(np.shape(denominator)), where=denominator != 0)
+
+        return hr
+
+
+    def plot_line(self, y, x, f, title='', include_plotlyjs='cdn'):
         ## Generate line plot of a single-dimension signal over time
         # y -> 1d signal values
         # x -> time/frequency values of equal length to y
         # f -> file object for saving
         # title -> plot title
+        # include_plotlyjs -> plotly.js script to write with the plot, only needed once per file (False to skip)
 
-        df = pd.DataFrame(dict(
-            x=x,
-            y=y
-        ))
-        fig = px.line(df, x="x", y=df.columns[0:len(y)], title=title)
-        #fig.show()
-        f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
+        # arrays go straight to a WebGL trace, no DataFrame needed
+        fig = go.Figure(go.Scattergl(x=x, y=y))
+        fig.update_layout(title=title)
+        fig.write_html(f, full_html=False, include_plotlyjs=include_plotlyjs)
         f.write("<hr>\n<hr>\n")
 
         return 0
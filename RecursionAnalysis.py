@@ -1,7 +1,22 @@
 import plotly.express as px
 import pandas as pd
+import numpy as np
 from numpy import zeros, mean
-from math import sqrt
+from collections import deque
+from joblib import Parallel, delayed
+
+
+def analyze_batch(analyzer, datasets, filenames, title='Recursion Analysis of Dataset', n_jobs=-1):
+    ## Run analyze_dataset() over many datasets (e.g. subjects or trials) in parallel threads
+    # analyzer -> configured RecursionAnalysis() object, shared as analyze_dataset() does not change it
+    # datasets -> list of complete arrays of signal over time
+    # filenames -> output file for each dataset's charts, overwritten on run
+    # title -> output document title
+    # n_jobs -> number of threads, -1 uses every core
+
+    return Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(analyzer.analyze_dataset)(dataset, filename=filename, title=title)
+        for dataset, filename in zip(datasets, filenames))
 
 
 class RecursionAnalysis():
@@ -19,15 +34,36 @@ class RecursionAnalysis():
         self.refresh_time = ref
 
         # Other variable initializations
-        self.saved_ra_points = []
-        self.saved_input_points = []
         self.max_input_points = (self.dimensions * self.time_lag)
+        #bounded buffer drops the oldest point by itself once full, one more than needed so insert_pt knows when to start
+        self.saved_input_points = deque(maxlen=self.max_input_points + 1)
+        #(points, dimensions) storage for insert_pt, grown as needed
+        self.saved_ra_points = []
 
         # Compute necessary time-lagged indices to grab
-        self.need_indices = []
-        for i in range(0, dim):
-            #computes last point, then TIMELAG before it for DIMENSION numbers
-            self.need_indices.append(self.max_input_points - ( i * self.time_lag ))
+        #computes last point, then TIMELAG before it for DIMENSION numbers
+        self.need_indices = self.max_input_points - (np.arange(0, dim) * self.time_lag)
+        #same indices counted back from the newest point, so the buffer may hold extra older points
+        self.need_offsets = self.need_indices - self.max_input_points - 1
+
+
+    @property
+    def saved_ra_points(self):
+        ## Recursion analysis points saved so far by insert_pt, as a (points, dimensions) array
+        return self._ra_buffer[:self._ra_count]
+
+
+    @saved_ra_points.setter
+    def saved_ra_points(self, points):
+        ## Replace saved recursion analysis points, e.g. with [] to clear live state
+        # points -> sequence of points, each with DIMENSION values
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.dimensions)
+
+        #start with room for 256 points, insert_pt doubles it when full
+        self._ra_buffer = np.empty((max(len(points), 256), self.dimensions), dtype=np.float64)
+        self._ra_buffer[:len(points)] = points
+        self._ra_count = len(points)
 
 
     def analyze_dataset(self, dataset, filename='compiled_charts.html', title='Recursion Analysis of Dataset'):
@@ -36,14 +72,17 @@ class RecursionAnalysis():
         # filename -> output file for charts, overwrites on run
         # title -> output document title
 
-        saved_ra_points = []
-        for x in range(self.max_input_points, len(dataset)):
-            saved_ra_points.append(self.get_timelag_points(dataset[x-self.max_input_points:x]))
+        #each dimension is a shifted copy of the signal, so fill the (points, dimensions) array a column at a time
+        dataset = np.asarray(dataset, dtype=np.float64)
+        num_points = max(len(dataset) - self.max_input_points, 0)
+        saved_ra_points = np.empty((num_points, self.dimensions), dtype=np.float64)
+        for dim, idx in enumerate(self.need_indices):
+            saved_ra_points[:, dim] = dataset[idx - 1:idx - 1 + num_points]
 
         with open(filename, 'w+') as f:
             f.write(f"<h1>{title}</h1>\n")
             self.plot_line(dataset[self.max_input_points::], f, title='Plotted Signal')
-            self.recursion_plot(saved_ra_points, f)
+            self.recursion_plot(saved_ra_points, f, include_plotlyjs=False)
 
         return 0
 
@@ -57,12 +96,14 @@ class RecursionAnalysis():
 
         #can't start calculating if there's not enough datapoints ¯\_(ツ)_/¯
         if len(self.saved_input_points) > self.max_input_points:
-            #remove first value of the array to keep it from getting too long? is it algorithmically quicker to not?
-            self.saved_input_points.pop(0)
-
             #take indices of time-lagged points and save to array
             timelag_values = self.get_timelag_points(self.saved_input_points)
-            self.saved_ra_points.append(timelag_values)
+
+            #double the storage array when full rather than reallocating every frame
+            if self._ra_count == len(self._ra_buffer):
+                self._ra_buffer = np.concatenate((self._ra_buffer, np.empty_like(self._ra_buffer)))
+            self._ra_buffer[self._ra_count] = timelag_values
+            self._ra_count += 1
 
         return 0
 
@@ -71,43 +112,42 @@ class RecursionAnalysis():
         ## Pull points from overall array with timelag separation
         # dataset -> containing just enough values to pull from current to farthest back time_lag
 
-        #initialize storage array
-        grab_values = []
-
-        #iterate over DIMENSION predetermined indices at TIME_LAG intervals.
-        for idx in self.need_indices:
-            grab_values.append(dataset[idx-1])
+        #convert buffer (e.g. the live deque) to an array so all points can be taken at once
+        if not isinstance(dataset, np.ndarray):
+            dataset = np.fromiter(dataset, dtype=np.float64, count=len(dataset))
 
-        return grab_values
+        #gather DIMENSION predetermined indices at TIME_LAG intervals.
+        return dataset[self.need_offsets]
 
 
-    def recursion_plot(self, ra_points, f):
+    def recursion_plot(self, ra_points, f, include_plotlyjs='cdn'):
         ## Analyze dimensional points to draw 2D recursion plot of those satisfying the criteria
         # ra_points -> Dimensional recursion analysis points
         # f -> file object to save output to
+        # include_plotlyjs -> plotly.js script to write with the plots, only needed once per file (False to skip)
 
         #unzip data from current form (array of [x,y] points) into heatmap (square array)
-        #TODO: find quick way to mirror table halves (add each array to the end of the other?) for display
-
-        #initialize sqare array
-        rp = []
 
-        #iterate twice over the length of saved points array, so that each point checks against every other
-        #TODO: OPTIMIZE ALGORITHMICALLY
-        for i in range(len(ra_points)):
-            newline = zeros(len(ra_points))
-            for j in range(i, len(ra_points)):
+        #pack points into a contiguous (points, dimensions) array and compare every point against every other
+        points = np.ascontiguousarray(ra_points, dtype=np.float64)
 
-                #initialize distances to store a point-to-point distance for each dimension
-                distances = []
-                for dim in range(0,self.dimensions):
-                    distances.append( (ra_points[i][dim] - ra_points[j][dim])**2 )
+        #fill a block of rows at a time so float differences never exist for the whole square at once. blocks are sized
+        #to keep each one around 2 million values (16 MB) whatever the number of points and dimensions
+        #only the upper half (j >= i) is needed, so each block starts at the column of its first row
+        block_rows = max(1, 2 ** 21 // max(points.shape[0] * points.shape[1], 1))
+        rp = zeros((len(points), len(points)), dtype=np.uint8)
+        for start in range(0, len(points), block_rows):
+            stop = min(start + block_rows, len(points))
+            #dimensional distances are taken directly, as expanding |p_i - p_j|^2 loses precision near the radius
+            diff = points[start:stop, None, :] - points[None, start:, :]
+            distances = np.sqrt((diff * diff).sum(-1))
 
-                #sums dimensional disatances to get magnitude of distance, marks positive if large enough
-                if sqrt(sum(distances)) <= self.radius:
-                    newline[j] = 1
+            #marks positive if close enough, then clears the corner of the block that falls below the diagonal
+            rp[start:stop, start:] = distances <= self.radius
+            rp[start:stop, start:stop] = np.triu(rp[start:stop, start:stop])
 
-            rp.append(newline)
+        #mirror the upper half onto the lower half for display, line analysis only reads the upper half
+        np.bitwise_or(rp, rp.T, out=rp)
 
         #get relevant RQA values
         avgL, maxL, over_timeL = self.line_analysis(rp)
@@ -120,9 +160,10 @@ class RecursionAnalysis():
         f.write(f"<h2>Lag={self.time_lag}, Dim={self.dimensions}, Rad={self.radius}</h2>\n")
         f.write(f"<h2>Avg Line: {round(avgL,3)}, Max Line: {maxL}</h2>\n")
         #save recursion plot to HTML output
-        f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
+        fig.write_html(f, full_html=False, include_plotlyjs=include_plotlyjs)
         #plot average line length over time and save to HTML output
-        self.plot_line(over_timeL, f, title="Measure of Stability via Average Diagonal Line Length at Time t")
+        self.plot_line(over_timeL, f, title="Measure of Stability via Average Diagonal Line Length at Time t",
+                       include_plotlyjs=False)
 
         return rp
 
@@ -131,68 +172,54 @@ class RecursionAnalysis():
         ## Calculate diagonal lines in bottom half of recursion plot
         # rp -> recursion plot heatmap
 
-        line_length = 0
-        line_lengths = []
+        rp = np.asarray(rp)
+        line_lengths = [np.empty(0, dtype=np.int64)]
 
         arr_total_len_by_time = zeros(len(rp))
         arr_num_entries_by_time = zeros(len(rp))
         arr_avg_len_by_time = zeros(len(rp))
 
-        #Create starting point for each diagonal analysis
+        #Create starting point for each diagonal analysis, x_start is also the column of the diagonal's first cell
         for x_start in range(1, len(rp)):
-
-            #using start point, create incrementing variable
-            x = x_start
-
-            #increment y variable, and use same for loop to increment x variable simultaneously for diagonal movement
-            for y in range(0, len(rp)-x):
-
-                #Check slot for 1, if 1 then increment line length
-                if rp[y][x] == 1:
-                    line_length += 1
-
-                    #Alternate to complete-line-saving commented below
-                    arr_total_len_by_time[x] += min(line_length, self.refresh_time)
-                    arr_num_entries_by_time[x] += 1
-
-                #If 0, check if line length has anything recorded. If it does, reset.
-                else:
-                    if line_length > 0:
-                        line_lengths.append(line_length)
-
-                        #back-saves line length to all times that the line occurred over
-                        #for back_x in range(x-line_length, x):
-                        #    arr_total_len_by_time[back_x] += line_length
-                        #    arr_num_entries_by_time[back_x] += 1
-
-                        line_length = 0
-                x += 1
-
-            #Checks for hanging line length after loop is finished executing, and resets
-            if line_length > 0:
-                line_lengths.append(line_length)
-                for back_x in range(x - line_length, x):
-                    arr_total_len_by_time[back_x] += line_length
-                    arr_num_entries_by_time[back_x] += 1
-                line_length = 0
+            diagonal = np.diagonal(rp, offset=x_start) == 1
+
+            #run-length encode the diagonal: changes from 0 to 1 start a line, changes from 1 to 0 end it
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], diagonal, [0]))))
+            starts = edges[0::2]
+            lengths = edges[1::2] - starts
+            if len(lengths) == 0:
+                continue
+            line_lengths.append(lengths)
+
+            #each filled slot adds the line length so far (capped at refresh time) to its column
+            cells = np.flatnonzero(diagonal)
+            running_length = cells - np.repeat(starts, lengths) + 1
+            arr_total_len_by_time[cells + x_start] += np.minimum(running_length, self.refresh_time)
+            arr_num_entries_by_time[cells + x_start] += 1
+
+            #a line still running at the end of the diagonal also back-saves its length to all times it occurred over
+            if diagonal[-1]:
+                arr_total_len_by_time[len(rp) - lengths[-1]:] += lengths[-1]
+                arr_num_entries_by_time[len(rp) - lengths[-1]:] += 1
 
         #Calculate average and maximum line lengths
+        line_lengths = np.concatenate(line_lengths)
         avg_line = mean(line_lengths)
-        max_line = max(line_lengths)
+        max_line = line_lengths.max()
 
         #Calculate average line length for each individual time step
-        for i in range(0,len(arr_total_len_by_time)):
-            if arr_num_entries_by_time[i] != 0:
-                arr_avg_len_by_time[i] = arr_total_len_by_time[i] / arr_num_entries_by_time[i]
+        np.divide(arr_total_len_by_time, arr_num_entries_by_time, out=arr_avg_len_by_time,
+                  where=arr_num_entries_by_time != 0)
 
         return avg_line, max_line, arr_avg_len_by_time
 
 
-    def plot_line(self, y, f, title=''):
+    def plot_line(self, y, f, title='', include_plotlyjs='cdn'):
         ## Generate line plot of a single-dimension signal over time
         # y -> 1d signal values
         # f -> file object for saving
         # title -> plot title
+        # include_plotlyjs -> plotly.js script to write with the plot, only needed once per file (False to skip)
 
         x = list(range(0,len(y)))
         df = pd.DataFrame(dict(
@@ -200,7 +227,7 @@ class RecursionAnalysis():
             y=y
         ))
         fig = px.line(df, x="t", y="y", title=title)
-        f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
+        fig.write_html(f, full_html=False, include_plotlyjs=include_plotlyjs)
         f.write("<hr>\n<hr>\n")
 
         return 0
\ No newline at end of file
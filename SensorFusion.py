@@ -1,5 +1,10 @@
+import copy
+import math
+
+import numba
 import numpy as np
-from scipy import interpolate
+from joblib import Parallel, delayed
+from scipy import signal
 
 # Selection of Kalman filter classes for IMU analysis
 
@@ -7,6 +12,261 @@ from scipy import interpolate
 # class kalman_filter_velocity() for fusing position and acceleration into walking speed
 
 
+def analyze_batch(kalman_filter, datasets, n_jobs=-1):
+    # Runs analyze_dataset() of a filter over many datasets (e.g. subjects or trials) in parallel threads
+    # The compiled filter passes release the GIL, so threads run on separate cores
+    # kalman_filter -> configured kalman_filter_6dof() or kalman_filter_velocity(), copied for each dataset
+    # datasets -> list of datasets, each in the format analyze_dataset() takes
+    # n_jobs -> number of threads, -1 uses every core
+    # Returns list of analyze_dataset() outputs in the same order as datasets
+    return Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(copy.deepcopy(kalman_filter).analyze_dataset)(dataset) for dataset in datasets)
+
+
+def _smooth(arr_to_smooth, window_length):
+    # Smooths evenly spaced samples with a Savitzky-Golay filter (cubic fit over window_length samples)
+    # window_length is cut to the largest odd length that fits, inputs too short for a cubic fit are returned unchanged
+    window_length = min(window_length, len(arr_to_smooth))
+    if window_length % 2 == 0:
+        window_length -= 1
+    if window_length <= 3:
+        return np.asarray(arr_to_smooth, dtype=np.float64)
+    return signal.savgol_filter(arr_to_smooth, window_length=window_length, polyorder=3)
+
+
+def _inv2(S):
+    # Closed-form inverse of a 2x2 matrix, np.linalg.inv is mostly call overhead at this size
+    det = S[0, 0] * S[1, 1] - S[0, 1] * S[1, 0]
+    return np.array([[S[1, 1], -S[0, 1]],
+                     [-S[1, 0], S[0, 0]]]) / det
+
+
+@numba.njit(cache=True, fastmath=True, nogil=True)
+def _run_6dof(time_arr, gy, ac, Q, R, C, x0, P0):
+    # Compiled equivalent of calling kalman_filter_6dof.update() for every sample of a dataset
+    # time_arr -> (samples,) time values
+    # gy, ac -> (samples, 3) gyroscope and accelerometer values
+    # Q, R, C -> filter coefficient arrays, (4, 4), (2, 2) and (2, 4)
+    # x0, P0 -> starting state (4,) and covariance (4, 4)
+    # Returns roll, pitch, accelerometer angles and euler angle derivatives (degrees) per sample, then final x and P
+
+    n = len(time_arr)
+    roll_arr = np.zeros(n)
+    pitch_arr = np.zeros(n)
+    acc_angle_roll = np.zeros(n)
+    acc_angle_pitch = np.zeros(n)
+    roll_dot_arr = np.zeros(n)
+    pitch_dot_arr = np.zeros(n)
+
+    x = x0.copy()
+    P = P0.copy()
+    A = np.eye(4)
+    x_new = np.empty(4)
+    AP = np.empty((4, 4))
+    PCt = np.empty((4, 2))
+    K = np.empty((4, 2))
+    KC = np.empty((4, 4))
+    P_new = np.empty((4, 4))
+    y_new = np.empty(2)
+
+    # Previous accelerometer values for the rolling 2-sample mean, starting from 0 as in reset()
+    acc_prev = np.zeros(3)
+
+    for i in range(1, n):
+        dt = time_arr[i] - time_arr[i - 1]
+
+        acc_x_mean = (acc_prev[0] + ac[i, 0]) * 0.5
+        acc_y_mean = (acc_prev[1] + ac[i, 1]) * 0.5
+        acc_z_mean = (acc_prev[2] + ac[i, 2]) * 0.5
+        acc_prev[0] = ac[i, 0]
+        acc_prev[1] = ac[i, 1]
+        acc_prev[2] = ac[i, 2]
+
+        gyro_x = math.radians(gy[i, 0])
+        gyro_y = math.radians(gy[i, 1])
+        gyro_z = math.radians(gy[i, 2])
+        roll_current = x[0]
+        pitch_current = x[2]
+
+        # Calculate accelerometer angles
+        accel_roll = -math.atan2(acc_z_mean, math.sqrt((acc_y_mean * acc_y_mean) + (acc_x_mean * acc_x_mean)))
+        accel_pitch = math.atan2(-acc_x_mean, math.sqrt((acc_z_mean * acc_z_mean) + (acc_y_mean * acc_y_mean)))
+        acc_angle_roll[i] = math.degrees(accel_roll)
+        acc_angle_pitch[i] = math.degrees(accel_pitch)
+
+        # Get euler angle derivatives of input gyroscope values
+        sin_roll = math.sin(roll_current)
+        cos_roll = math.cos(roll_current)
+        tan_pitch = math.tan(pitch_current)
+        roll_dot = gyro_x + (sin_roll * tan_pitch * gyro_z) + (cos_roll * tan_pitch * gyro_y)
+        pitch_dot = cos_roll * gyro_z - sin_roll * gyro_y
+        roll_dot_arr[i] = math.degrees(roll_dot)
+        pitch_dot_arr[i] = math.degrees(pitch_dot)
+
+        # Prediction equations, with B.dot(measured_input) written out as [dt * roll_dot, 0, dt * pitch_dot, 0]
+        A[0, 1] = -dt
+        A[2, 3] = -dt
+        for r in range(4):
+            x_new[r] = 0.0
+            for k in range(4):
+                x_new[r] += A[r, k] * x[k]
+        x_new[0] += dt * roll_dot
+        x_new[2] += dt * pitch_dot
+
+        for r in range(4):
+            for c in range(4):
+                AP[r, c] = 0.0
+                for k in range(4):
+                    AP[r, c] += A[r, k] * P[k, c]
+        for r in range(4):
+            for c in range(4):
+                P[r, c] = Q[r, c]
+                for k in range(4):
+                    P[r, c] += AP[r, k] * A[c, k]
+
+        # Update equations, with the 2x2 inverse of S written out
+        for r in range(4):
+            for c in range(2):
+                PCt[r, c] = 0.0
+                for k in range(4):
+                    PCt[r, c] += P[r, k] * C[c, k]
+        s00 = R[0, 0]
+        s01 = R[0, 1]
+        s10 = R[1, 0]
+        s11 = R[1, 1]
+        for k in range(4):
+            s00 += C[0, k] * PCt[k, 0]
+            s01 += C[0, k] * PCt[k, 1]
+            s10 += C[1, k] * PCt[k, 0]
+            s11 += C[1, k] * PCt[k, 1]
+        det = s00 * s11 - s01 * s10
+        for r in range(4):
+            K[r, 0] = (PCt[r, 0] * s11 - PCt[r, 1] * s10) / det
+            K[r, 1] = (PCt[r, 1] * s00 - PCt[r, 0] * s01) / det
+
+        y_new[0] = accel_roll
+        y_new[1] = accel_pitch
+        for a in range(2):
+            for k in range(4):
+                y_new[a] -= C[a, k] * x_new[k]
+        for r in range(4):
+            x[r] = x_new[r] + K[r, 0] * y_new[0] + K[r, 1] * y_new[1]
+
+        for r in range(4):
+            for c in range(4):
+                KC[r, c] = K[r, 0] * C[0, c] + K[r, 1] * C[1, c]
+        for r in range(4):
+            for c in range(4):
+                P_new[r, c] = P[r, c]
+                for k in range(4):
+                    P_new[r, c] -= KC[r, k] * P[k, c]
+        P[:, :] = P_new
+
+        roll_arr[i] = math.degrees(x[0])
+        pitch_arr[i] = math.degrees(x[2])
+
+    return roll_arr, pitch_arr, acc_angle_roll, acc_angle_pitch, roll_dot_arr, pitch_dot_arr, x, P
+
+
+@numba.njit(cache=True, fastmath=True, nogil=True, error_model='numpy')
+def _run_velocity(time_arr, ac, pitch, position, Q, R, C, x0, P0):
+    # Compiled equivalent of calling kalman_filter_velocity.update() for every sample of a dataset
+    # time_arr, pitch, position -> (samples,) time, pitch (degrees) and position values
+    # ac -> (samples, 2) x and y accelerometer values
+    # Q, R, C -> filter coefficient arrays, each (2, 2)
+    # x0, P0 -> starting state (2,) and covariance (2, 2)
+    # Returns speed and forward acceleration per sample, forward acceleration offset, then final x and P
+
+    n = len(time_arr)
+    speed_arr = np.zeros(n)
+    ac_forward_arr = np.zeros(n)
+    ac_forward_offset = 0.0
+
+    x = x0.copy()
+    P = P0.copy()
+    AP = np.empty((2, 2))
+    PCt = np.empty((2, 2))
+    K = np.empty((2, 2))
+    KCP = np.empty((2, 2))
+    y_new = np.empty(2)
+
+    # Previous accelerometer values for the rolling 2-sample mean, starting from 0 as in reset()
+    ac_x_prev = 0.0
+    ac_y_prev = 0.0
+    current_position = 0.0
+
+    for i in range(1, n):
+        dt = time_arr[i] - time_arr[i - 1]
+
+        ac_x_mean = 0.5 * (ac_x_prev + ac[i, 0])
+        ac_y_mean = 0.5 * (ac_y_prev + ac[i, 1])
+        ac_x_prev = ac[i, 0]
+        ac_y_prev = ac[i, 1]
+
+        # Using pitch, approximate forward acceleration component
+        pitch_rad = math.radians(pitch[i])
+        ac_forward = (ac_x_mean * math.cos(pitch_rad)) - (ac_y_mean * math.sin(pitch_rad))
+
+        # Offset is taken from updates 100-199 once 200 have passed, and no acceleration is used until then
+        if i > 201:
+            ac_forward -= ac_forward_offset
+        elif i > 200:
+            ac_forward_offset = np.mean(ac_forward_arr[100:200])
+            ac_forward_arr[:i] -= ac_forward_offset
+            ac_forward -= ac_forward_offset
+        ac_forward_arr[i] = ac_forward
+        if i <= 200:
+            ac_forward = 0.0
+
+        speed_from_position = (position[i] - current_position) / dt
+        current_position = position[i]
+
+        # Prediction equations, with A = [[1, dt], [0, 1]] and B = [[-dt^2 / 2], [dt]] written out
+        x_new0 = x[0] + dt * x[1] - (dt * dt / 2) * ac_forward
+        x_new1 = x[1] + dt * ac_forward
+
+        AP[0, 0] = P[0, 0] + dt * P[1, 0]
+        AP[0, 1] = P[0, 1] + dt * P[1, 1]
+        AP[1, 0] = P[1, 0]
+        AP[1, 1] = P[1, 1]
+        P[0, 0] = AP[0, 0] + dt * AP[0, 1] + Q[0, 0]
+        P[0, 1] = AP[0, 1] + Q[0, 1]
+        P[1, 0] = AP[1, 0] + dt * AP[1, 1] + Q[1, 0]
+        P[1, 1] = AP[1, 1] + Q[1, 1]
+
+        # Update equations, with the 2x2 inverse of S written out
+        for r in range(2):
+            for c in range(2):
+                PCt[r, c] = P[r, 0] * C[c, 0] + P[r, 1] * C[c, 1]
+        s00 = C[0, 0] * PCt[0, 0] + C[0, 1] * PCt[1, 0] + R[0, 0]
+        s01 = C[0, 0] * PCt[0, 1] + C[0, 1] * PCt[1, 1] + R[0, 1]
+        s10 = C[1, 0] * PCt[0, 0] + C[1, 1] * PCt[1, 0] + R[1, 0]
+        s11 = C[1, 0] * PCt[0, 1] + C[1, 1] * PCt[1, 1] + R[1, 1]
+        det = s00 * s11 - s01 * s10
+        for r in range(2):
+            K[r, 0] = (PCt[r, 0] * s11 - PCt[r, 1] * s10) / det
+            K[r, 1] = (PCt[r, 1] * s00 - PCt[r, 0] * s01) / det
+
+        # The single position-derived speed is compared against both rows of C.dot(x_new)
+        for a in range(2):
+            y_new[a] = speed_from_position - (C[a, 0] * x_new0 + C[a, 1] * x_new1)
+        x[0] = x_new0 + K[0, 0] * y_new[0] + K[0, 1] * y_new[1]
+        x[1] = x_new1 + K[1, 0] * y_new[0] + K[1, 1] * y_new[1]
+
+        for r in range(2):
+            for c in range(2):
+                KCP[r, c] = 0.0
+                for a in range(2):
+                    KCP[r, c] += K[r, a] * (C[a, 0] * P[0, c] + C[a, 1] * P[1, c])
+        for r in range(2):
+            for c in range(2):
+                P[r, c] -= KCP[r, c]
+
+        speed_arr[i] = x[1]
+
+    return speed_arr, ac_forward_arr, ac_forward_offset, x, P
+
+
 class kalman_filter_6dof():
 
     # Kalman Filter for 6DoF IMU Sensor Fusion
@@ -19,7 +279,7 @@ class kalman_filter_6dof():
     # update(accelerometer, position, pitch, dt): Adds new values to filter and updates prediction
     # analyze_dataset(dataset): Iterates through data to post-process a complete dataset
     # zero(signal): Uses seconds 2-4 of given signal to compute offset that is applied to the entire signal
-    # smooth(input_arr, time_arr): Smooths curve
+    # smooth(input_arr, window_length): Smooths curve with a cubic fit over window_length evenly spaced samples
 
     # Usage:
     # Creating object:
@@ -60,9 +320,10 @@ class kalman_filter_6dof():
                            [0, 0, 1, 0],
                            [0, 0, 0, 1]])
 
-        self.acc_x = [0, 0]
-        self.acc_y = [0, 0]
-        self.acc_z = [0, 0]
+        # Previous and current accelerometer values for the rolling 2-sample mean
+        self._acc_x_prev = self._acc_x_cur = 0
+        self._acc_y_prev = self._acc_y_cur = 0
+        self._acc_z_prev = self._acc_z_cur = 0
 
         self.acc_angle_roll = [0]
         self.acc_angle_pitch = [0]
@@ -90,20 +351,35 @@ class kalman_filter_6dof():
         ac_y = dataset[5]
         ac_z = dataset[6]
 
+        # Pack inputs once and run every update() step in a single compiled pass
+        time_arr = np.asarray(time_arr, dtype=np.float64)
+        gy = np.ascontiguousarray(np.column_stack((gy_x, gy_y, gy_z)), dtype=np.float64)
+        ac = np.ascontiguousarray(np.column_stack((ac_x, ac_y, ac_z)), dtype=np.float64)
+
         self.reset()
-        roll_arr = [0]
-        pitch_arr = [0]
-        for i in range(1, len(time_arr)):
-            dt = time_arr[i] - time_arr[i - 1]
-            roll, pitch = self.update([gy_x[i], gy_y[i], gy_z[i]], [ac_x[i], ac_y[i], ac_z[i]], dt)
-            roll_arr.append(roll)
-            pitch_arr.append(pitch)
+        roll_arr, pitch_arr, acc_angle_roll, acc_angle_pitch, roll_dot_arr, pitch_dot_arr, x, P = _run_6dof(
+            time_arr, gy, ac,
+            np.asarray(self.Q, dtype=np.float64), np.asarray(self.R, dtype=np.float64),
+            np.asarray(self.C, dtype=np.float64), np.asarray(self.x[:, 0], dtype=np.float64),
+            np.asarray(self.P, dtype=np.float64))
+
+        # Leave the object in the same state as calling update() for each sample
+        self.x = x.reshape(4, 1)
+        self.P = P
+        acc_last = np.vstack((np.zeros((2, 3)), ac[1:]))[-2:]
+        self._acc_x_prev, self._acc_y_prev, self._acc_z_prev = acc_last[0]
+        self._acc_x_cur, self._acc_y_cur, self._acc_z_cur = acc_last[1]
+        self.acc_angle_roll = list(acc_angle_roll)
+        self.acc_angle_pitch = list(acc_angle_pitch)
+        self.roll_dot_arr = list(roll_dot_arr)
+        self.pitch_dot_arr = list(pitch_dot_arr)
+        self.update_number = max(len(time_arr) - 1, 0)
 
         roll_arr = self.zero(roll_arr)
         pitch_arr = self.zero(pitch_arr)
 
-        #roll_arr = self.smooth(roll_arr, time_arr, smooth_coeff=1)
-        #pitch_arr = self.smooth(pitch_arr, time_arr, smooth_coeff=1)
+        #roll_arr = self.smooth(roll_arr, window_length=51)
+        #pitch_arr = self.smooth(pitch_arr, window_length=51)
 
         return roll_arr, pitch_arr
 
@@ -112,25 +388,23 @@ class kalman_filter_6dof():
         # Returns roll and pitch and updates system
         # Unpack inputs
         self.update_number += 1
-        self.acc_x.append(accelerometer[0])
-        self.acc_y.append(accelerometer[1])
-        self.acc_z.append(accelerometer[2])
-        self.acc_x.pop(0)
-        self.acc_y.pop(0)
-        self.acc_z.pop(0)
-        acc_x_mean = np.mean(self.acc_x)
-        acc_y_mean = np.mean(self.acc_y)
-        acc_z_mean = np.mean(self.acc_z)
-
-        gyro_x = np.radians(gyroscope[0])
-        gyro_y = np.radians(gyroscope[1])
-        gyro_z = np.radians(gyroscope[2])
+        self._acc_x_prev, self._acc_x_cur = self._acc_x_cur, accelerometer[0]
+        self._acc_y_prev, self._acc_y_cur = self._acc_y_cur, accelerometer[1]
+        self._acc_z_prev, self._acc_z_cur = self._acc_z_cur, accelerometer[2]
+        acc_x_mean = 0.5 * (self._acc_x_prev + self._acc_x_cur)
+        acc_y_mean = 0.5 * (self._acc_y_prev + self._acc_y_cur)
+        acc_z_mean = 0.5 * (self._acc_z_prev + self._acc_z_cur)
+
+        # Scalar math functions, np equivalents round-trip through arrays for single values
+        gyro_x = math.radians(gyroscope[0])
+        gyro_y = math.radians(gyroscope[1])
+        gyro_z = math.radians(gyroscope[2])
         roll_current = self.x[0][0]
         pitch_current = self.x[2][0]
 
         # Calculate accelerometer angles
-        accel_roll = -np.arctan2(acc_z_mean, np.sqrt((acc_y_mean * acc_y_mean) + (acc_x_mean * acc_x_mean)))
-        accel_pitch = np.arctan2(-acc_x_mean, np.sqrt((acc_z_mean * acc_z_mean) + (acc_y_mean * acc_y_mean)))
+        accel_roll = -math.atan2(acc_z_mean, math.sqrt((acc_y_mean * acc_y_mean) + (acc_x_mean * acc_x_mean)))
+        accel_pitch = math.atan2(-acc_x_mean, math.sqrt((acc_z_mean * acc_z_mean) + (acc_y_mean * acc_y_mean)))
 
         #if self.update_number > 51:
         #    accel_roll -= self.acc_roll_off
@@ -146,17 +420,18 @@ class kalman_filter_6dof():
         #    self.roll_calib_arr.append(accel_roll)
         #    self.pitch_calib_arr.append(accel_pitch)
 
-        self.acc_angle_roll.append(np.degrees(accel_roll))
-        self.acc_angle_pitch.append(np.degrees(accel_pitch))
+        self.acc_angle_roll.append(math.degrees(accel_roll))
+        self.acc_angle_pitch.append(math.degrees(accel_pitch))
 
-        # Get euler angle derivatives of input gyroscope values
-        roll_dot = gyro_x \
-                   + (np.sin(roll_current) * np.tan(pitch_current) * gyro_z) \
-                   + (np.cos(roll_current) * np.tan(pitch_current) * gyro_y)
-        pitch_dot = np.cos(roll_current) * gyro_z - np.sin(roll_current) * gyro_y
+        # Get euler angle derivatives of input gyroscope values, taking each trig value once
+        sin_roll = math.sin(roll_current)
+        cos_roll = math.cos(roll_current)
+        tan_pitch = math.tan(pitch_current)
+        roll_dot = gyro_x + (sin_roll * tan_pitch * gyro_z) + (cos_roll * tan_pitch * gyro_y)
+        pitch_dot = cos_roll * gyro_z - sin_roll * gyro_y
 
-        self.roll_dot_arr.append(np.degrees(roll_dot))
-        self.pitch_dot_arr.append(np.degrees(pitch_dot))
+        self.roll_dot_arr.append(math.degrees(roll_dot))
+        self.pitch_dot_arr.append(math.degrees(pitch_dot))
 
         # Calculate A and B arrays based on time step
         A = np.array([[1, -dt, 0, 0],
@@ -180,13 +455,14 @@ class kalman_filter_6dof():
         # Update equations
         y_new = acceleration_estimates - self.C.dot(x_new)
         S = self.C.dot(self.P.dot(np.transpose(self.C))) + self.R
-        K = self.P.dot(np.transpose(self.C).dot(np.linalg.inv(S)))
+        K = self.P.dot(np.transpose(self.C).dot(_inv2(S)))
         x_new = x_new + K.dot(y_new)
 
         self.x = x_new
-        self.P = (np.eye(4) - K.dot(self.C)).dot(self.P)
+        # (I - KC)P, without building the identity matrix
+        self.P = self.P - K.dot(self.C.dot(self.P))
 
-        return np.degrees(self.x[0][0]), np.degrees(self.x[2][0])
+        return math.degrees(self.x[0][0]), math.degrees(self.x[2][0])
 
     def zero(self, arr):
         # Zeroes input function based on seconds 4-6 of data
@@ -194,11 +470,9 @@ class kalman_filter_6dof():
         output = [x - calib_val for x in arr]
         return output
 
-    def smooth(self, arr_to_smooth, time_arr, smooth_coeff=1):
-        # Smooths input function using a univariate spline
-        smoothed_arr = interpolate.UnivariateSpline(time_arr, arr_to_smooth, s=smooth_coeff)
-        smoothed_arr = smoothed_arr(time_arr)
-        return smoothed_arr
+    def smooth(self, arr_to_smooth, window_length=51):
+        # Smooths input function, window_length -> samples per cubic fit (see _smooth)
+        return _smooth(arr_to_smooth, window_length)
 
 
 class kalman_filter_velocity():
@@ -212,7 +486,7 @@ class kalman_filter_velocity():
     # reset(): Sets any changing variables to 0 for a new dataset to be processed
     # update(accelerometer, position, pitch, dt): Adds new values to filter and updates prediction
     # analyze_dataset(dataset): Iterates through data to post-process a complete dataset
-    # smooth(input_arr, time_arr): Smooths curve
+    # smooth(input_arr, window_length): Smooths curve with a cubic fit over window_length evenly spaced samples
 
     # Usage:
     # Creating object:
@@ -243,9 +517,9 @@ class kalman_filter_velocity():
 
 
     def reset(self):
-        self.ac_x = [0,0]
-        self.ac_y = [0,0]
-        self.ac_z = [0,0]
+        # Previous and current accelerometer values for the rolling 2-sample mean (z is not used)
+        self._ac_x_prev = self._ac_x_cur = 0
+        self._ac_y_prev = self._ac_y_cur = 0
 
         self.x = np.transpose(np.array([[0, 0]]))
 
@@ -263,15 +537,10 @@ class kalman_filter_velocity():
 
     def update(self, accelerometer, pitch, position, dt):
         self.update_number += 1
-        self.ac_x.append(accelerometer[0])
-        self.ac_y.append(accelerometer[1])
-        self.ac_z.append(accelerometer[2])
-        self.ac_x.pop(0)
-        self.ac_y.pop(0)
-        self.ac_z.pop(0)
-        ac_x_mean = np.mean(self.ac_x)
-        ac_y_mean = np.mean(self.ac_y)
-        ac_z_mean = np.mean(self.ac_z)
+        self._ac_x_prev, self._ac_x_cur = self._ac_x_cur, accelerometer[0]
+        self._ac_y_prev, self._ac_y_cur = self._ac_y_cur, accelerometer[1]
+        ac_x_mean = 0.5 * (self._ac_x_prev + self._ac_x_cur)
+        ac_y_mean = 0.5 * (self._ac_y_prev + self._ac_y_cur)
 
         # Using pitch, approximate forward acceleration component
         ac_forward = (ac_x_mean * np.cos(np.radians(pitch))) - (ac_y_mean * np.sin(np.radians(pitch)))
@@ -310,38 +579,52 @@ class kalman_filter_velocity():
         # Update equations
         y_new = estimates - self.C.dot(x_new)
         S = self.C.dot(self.P.dot(np.transpose(self.C))) + self.R
-        K = self.P.dot(np.transpose(self.C).dot(np.linalg.inv(S)))
+        K = self.P.dot(np.transpose(self.C).dot(_inv2(S)))
         x_new = x_new + K.dot(y_new)
 
         self.x = x_new
-        self.P = (np.eye(2) - K.dot(self.C)).dot(self.P)
+        # (I - KC)P, without building the identity matrix
+        self.P = self.P - K.dot(self.C.dot(self.P))
 
         return self.x[1][0]
 
 
     def analyze_dataset(self, dataset):
         # Dataset includes 6 subarrays
-        time_arr = dataset[0]
+        time_arr = np.asarray(dataset[0], dtype=np.float64)
         ac_x = dataset[1]
         ac_y = dataset[2]
-        ac_z = dataset[3]
-        pitch = dataset[4]
-        position = dataset[5]
+        pitch = np.asarray(dataset[4], dtype=np.float64)
+        position = np.asarray(dataset[5], dtype=np.float64)
+
+        # Pack inputs once and run every update() step in a single compiled pass (ac_z is not used)
+        ac = np.ascontiguousarray(np.column_stack((ac_x, ac_y)), dtype=np.float64)
 
         self.reset()
-        speed_arr = [0]
-        for i in range(1, len(time_arr)):
-            dt = time_arr[i] - time_arr[i-1]
-            speed_arr.append(self.update([ac_x[i], ac_y[i], ac_z[i]], pitch[i], position[i], dt))
+        speed_arr, ac_forward, ac_forward_offset, x, P = _run_velocity(
+            time_arr, ac, pitch, position,
+            np.asarray(self.Q, dtype=np.float64), np.asarray(self.R, dtype=np.float64),
+            np.asarray(self.C, dtype=np.float64), np.asarray(self.x[:, 0], dtype=np.float64),
+            np.asarray(self.P, dtype=np.float64))
+
+        # Leave the object in the same state as calling update() for each sample
+        self.x = x.reshape(2, 1)
+        self.P = P
+        ac_last = np.vstack((np.zeros((2, 2)), ac[1:]))[-2:]
+        self._ac_x_prev, self._ac_y_prev = ac_last[0]
+        self._ac_x_cur, self._ac_y_cur = ac_last[1]
+        self.current_position = position[-1] if len(time_arr) > 1 else 0
+        self.ac_forward = list(ac_forward)
+        self.ac_forward_offset = ac_forward_offset
+        self.update_number = max(len(time_arr) - 1, 0)
+
         speed_arr = self.zero(speed_arr)
         return speed_arr
 
 
-    def smooth(self, arr_to_smooth, time_arr, smooth_coeff=1):
-        # Smooths input function using a univariate spline
-        smoothed_arr = interpolate.UnivariateSpline(time_arr, arr_to_smooth, s=smooth_coeff)
-        smoothed_arr = smoothed_arr(time_arr)
-        return smoothed_arr
+    def smooth(self, arr_to_smooth, window_length=51):
+        # Smooths input function, window_length -> samples per cubic fit (see _smooth)
+        return _smooth(arr_to_smooth, window_length)
 
 
     def zero(self, arr):